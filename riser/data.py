@@ -2,7 +2,7 @@ import torch
 from torch.utils.data.dataset import Dataset
 
 class SignalDataset(Dataset):
-    def __init__(self, positive_file, negative_file):
+    def __init__(self, positive_file, negative_file, dtype=None):
         n_x = torch.load(negative_file)
         p_x = torch.load(positive_file)
 
@@ -13,6 +13,8 @@ class SignalDataset(Dataset):
         p_y = torch.ones(p_x.shape[0], dtype=torch.long)
 
         self.data  = torch.cat((n_x, p_x))
+        if dtype is not None:
+            self.data = self.data.to(dtype)
         self.label = torch.cat((n_y, p_y))
 
         print(f"Shape of total dataset: {self.data.shape}")
@@ -22,6 +24,43 @@ class SignalDataset(Dataset):
         return len(self.label)
 
     def __getitem__(self, idx):
+        # idx may be a list of indices, in which case a whole batch is
+        # gathered with a single indexing op
         x = self.data[idx]
         y = self.label[idx]
         return x, y
+
+
+class CUDAPrefetcher():
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        next_batch = self._preload(batches)
+        while next_batch is not None:
+            # Wait for this batch's copy to finish, then start copying the
+            # next batch on the side stream while this one is consumed
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            X, y = next_batch
+            X.record_stream(current_stream)
+            y.record_stream(current_stream)
+            next_batch = self._preload(batches)
+            yield X, y
+
+    def _preload(self, batches):
+        try:
+            X, y = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            X = X.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
+        return X, y
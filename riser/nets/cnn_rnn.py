@@ -15,16 +15,12 @@ class ConvRecNet(nn.Module):
             in_channels = 1 if i == 0 else c.channels[i-1]
             layer = self._make_conv_layer(in_channels, c.channels[i], c.kernels[i])
             conv_layers.append(layer)
-        self.conv_layers = nn.ModuleList(conv_layers)
+        self.conv_layers = nn.Sequential(*conv_layers)
 
-        # Recurrent layers
-        rec_layers = []
+        # Recurrent layers (stacked within a single module so that cuDNN
+        # can run all layers in one fused call)
         output_dim = c.hidden * 2 if c.bidirectional else c.hidden
-        for i in range(c.n_rec_layers):
-            # First layer takes last conv layer output
-            input_dim = c.channels[-1] if i == 0 else output_dim
-            rec_layers.append(self._make_rec_layer(input_dim, c))
-        self.rec_layers = nn.ModuleList(rec_layers)
+        self.rec = self._make_rec_layer(c.channels[-1], c)
 
         # Activation
         self.activation = nn.ReLU(inplace=True)
@@ -35,15 +31,23 @@ class ConvRecNet(nn.Module):
 
     def forward(self, x):
         x = x.unsqueeze(1)
-        for layer in self.conv_layers:
-            x = layer(x)
+        x = self.conv_layers(x)
         x = x.permute(0, 2, 1) # CNN outputs (B,C,L) & LSTM input is (B,L,C)
-        for layer in self.rec_layers:
-            x, _ = layer(x)
-            x = self.activation(x)
+        x, _ = self.rec(x)
+        x = self.activation(x)
         x = self.linear(x[:, -1, :]) # Hidden states for the last timestep
         return x
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the recurrent layers were merged into a
+        # single module store them under rec_layers.0 (stacks that were
+        # split over several modules cannot be remapped and still fail)
+        old_prefix = prefix + 'rec_layers.0.'
+        for key in list(state_dict.keys()):
+            if key.startswith(old_prefix):
+                state_dict[prefix + 'rec.' + key[len(old_prefix):]] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _make_conv_layer(self, in_channels, out_channels, kernel_size):
         layers = [
             nn.Conv1d(in_channels, out_channels, kernel_size),
@@ -53,19 +57,21 @@ class ConvRecNet(nn.Module):
         return nn.Sequential(*layers)
 
     def _make_rec_layer(self, input_dim, c):
+        # Dropout only applies between stacked layers
+        dropout = c.dropout if c.n_rec_layers > 1 else 0
         if c.cell == "lstm":
             return nn.LSTM(input_dim,
                            c.hidden,
-                           c.n_rec_layers,
+                           num_layers=c.n_rec_layers,
                            batch_first=True,
-                           dropout=c.dropout,
+                           dropout=dropout,
                            bidirectional=c.bidirectional)
         elif c.cell == "gru":
             return nn.GRU(input_dim,
                           c.hidden,
-                          c.n_rec_layers,
+                          num_layers=c.n_rec_layers,
                           batch_first=True,
-                          dropout=c.dropout,
+                          dropout=dropout,
                           bidirectional=c.bidirectional)
         else:
             print(f"Invalid config file: Cell = {c.cell}")
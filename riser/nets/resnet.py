@@ -1,9 +1,18 @@
+import torch
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 # from torchinfo import summary
 
 # from utilities import get_config
 
 
+@torch.jit.script
+def fused_add_relu(a, b):
+    # Scripted so the fuser can merge the residual sum and activation into
+    # one elementwise kernel
+    return torch.relu_(a + b)
+
+
 class ResidualBlock(nn.Module):
     def __init__(self, in_channels, out_channels, stride=1):
         super().__init__()
@@ -12,7 +21,6 @@ class ResidualBlock(nn.Module):
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.stride = stride
-        self.activation = nn.ReLU(inplace=True)
 
         # Convolutional blocks
         self.blocks = nn.Identity()
@@ -39,7 +47,7 @@ class ResidualBlock(nn.Module):
     def forward(self, x):
         residual = self.shortcut(x) if self.should_apply_shortcut else x
         out = self.blocks(x)
-        out = self.activation(out + residual)
+        out = fused_add_relu(out, residual)
         return out
 
     @property
@@ -89,7 +97,7 @@ class ResNet(nn.Module):
         for i in range(c.n_layers):
             stride = 1 if i == 0 else 2
             layers.append(self._make_layer(block, c.channels[i], c.blocks[i], stride))
-        self.layers = nn.ModuleList(layers)
+        self.layers = nn.Sequential(*layers)
 
         # Classifier
         self.decoder = nn.Sequential(
@@ -104,8 +112,7 @@ class ResNet(nn.Module):
     def forward(self, x):
         x = x.unsqueeze(1)
         x = self.conv_block(x)
-        for layer in self.layers:
-            x = layer(x)
+        x = self.layers(x)
         x = self.decoder(x)
         return x
 
@@ -121,6 +128,19 @@ class ResNet(nn.Module):
             blocks.append(block(self.in_channels, out_channels))
 
         return nn.Sequential(*blocks)
+
+    def fuse_bn(self):
+        # Fold each BatchNorm into the preceding convolution for inference,
+        # so that every conv + BN pair runs as a single convolution
+        assert not self.training, "BatchNorm can only be fused in eval mode"
+        for m in self.modules():
+            if not isinstance(m, nn.Sequential):
+                continue
+            for i in range(len(m) - 1):
+                if isinstance(m[i], nn.Conv1d) and isinstance(m[i+1], nn.BatchNorm1d):
+                    m[i] = fuse_conv_bn_eval(m[i], m[i+1])
+                    m[i+1] = nn.Identity()
+        return self
     
     def _init_weights(self):
         for m in self.modules():
@@ -6,13 +6,15 @@ from torch.nn.utils import weight_norm
 # from utilities import get_config
 
 
-class Chomp1d(nn.Module):
-    def __init__(self, chomp_size):
-        super(Chomp1d, self).__init__()
-        self.chomp_size = chomp_size
+class CausalConv1d(nn.Conv1d):
+    def __init__(self, in_channels, out_channels, kernel, dilation, padding):
+        super().__init__(in_channels, out_channels, kernel, stride=1, padding=0, dilation=dilation)
+        self.causal_padding = padding
 
     def forward(self, x):
-        return x[:, :, :-self.chomp_size].contiguous()
+        # Pad the start of the sequence only, so that outputs never see
+        # future inputs and no trailing outputs have to be chomped off
+        return super().forward(F.pad(x, (self.causal_padding, 0)))
 
 class TemporalBlock(nn.Module):
     def __init__(self, in_channels, out_channels, kernel, dilation, padding, dropout=0.2, reduction=4):
@@ -26,10 +28,10 @@ class TemporalBlock(nn.Module):
 
         # Causal convolutional blocks
         self.blocks = nn.Sequential(
-            self.conv_block(in_channels, self.channels, kernel=1, dilation=1, padding=0, dropout=0, chomp=False),
+            self.conv_block(in_channels, self.channels, kernel=1, dilation=1, padding=0, dropout=0, causal=False),
             self.conv_block(self.channels, self.channels, kernel, dilation, padding, dropout),
             self.conv_block(self.channels, self.channels, kernel, dilation, padding, dropout), # TODO: Update receptive field if single layer here
-            self.conv_block(self.channels, out_channels, kernel=1, dilation=1, padding=0, dropout=0, chomp=False),
+            self.conv_block(self.channels, out_channels, kernel=1, dilation=1, padding=0, dropout=0, causal=False),
         )
 
         # Match dimensions of block's input and output for summation
@@ -38,10 +40,12 @@ class TemporalBlock(nn.Module):
         # Initialise weights and biases
         self._init_weights()
 
-    def conv_block(self, in_channels, out_channels, kernel, dilation, padding, dropout, chomp=True):
-        layers = [weight_norm(nn.Conv1d(in_channels, out_channels, kernel, stride=1, padding=padding, dilation=dilation))]
-        if chomp is True:
-            layers.append(Chomp1d(padding))
+    def conv_block(self, in_channels, out_channels, kernel, dilation, padding, dropout, causal=True):
+        if causal is True:
+            conv = CausalConv1d(in_channels, out_channels, kernel, dilation, padding)
+        else:
+            conv = nn.Conv1d(in_channels, out_channels, kernel, stride=1, padding=padding, dilation=dilation)
+        layers = [weight_norm(conv)]
         layers.append(nn.ReLU()), # ReLU applied even at the last layer because https://github.com/locuslab/TCN/issues/34 
         layers.append(nn.Dropout(dropout))
         
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import random
 import sys
 import time
@@ -5,7 +7,8 @@ import time
 from pytorch_lightning.utilities import CombinedLoader
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
+import torch.nn.functional as F
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
 from torch.utils.tensorboard import SummaryWriter
 from torchinfo import summary
 
@@ -13,7 +16,7 @@ from nets.cnn import ConvNet
 from nets.resnet import ResNet
 from nets.tcn import TCN
 from nets.tcn_bot import TCNBot
-from data import SignalDataset
+from data import CUDAPrefetcher, SignalDataset
 from utilities import get_config
 
 def count_batches_in_combined_loader(combined_loader):
@@ -28,63 +31,109 @@ def count_samples_in_combined_loader(combined_loader):
         n_samples += len(loader.dataset)
     return n_samples
 
-def train(dataloader, model, loss_fn, optimizer, device, writer, epoch, log_freq=100):
+def combine_batches(batches):
+    # Left-pad shorter signals with zeros (as is done for short reads at
+    # test time) so that batches of all input lengths can be stacked
+    max_len = max(X.shape[1] for _, (X, _) in batches)
+    X = torch.cat([F.pad(X, (max_len - X.shape[1], 0)) for _, (X, _) in batches])
+    y = torch.cat([y for _, (_, y) in batches])
+
+    # Label the combined batch with the longest input length present
+    length = next(length for length, (X_i, _) in batches if X_i.shape[1] == max_len)
+    return length, (X, y)
+
+@contextmanager
+def length_stream(streams, length, X, y):
+    # Run work for this input length on its own CUDA stream, if enabled
+    if streams is None:
+        yield
+        return
+    stream = streams[length]
+    stream.wait_stream(torch.cuda.current_stream(X.device))
+
+    # Stop the allocator reusing the batch's memory while the side stream
+    # may still be reading it
+    X.record_stream(stream)
+    y.record_stream(stream)
+    with torch.cuda.stream(stream):
+        yield
+
+def train(dataloader, n_samples, model, compiled_model, loss_fn, optimizer, scaler, device, writer, epoch, combine_lengths=False, streams=None, log_freq=100):
     model.train()
 
-    # Compute number of batches and total number of training instances
-    n_samples = count_samples_in_combined_loader(dataloader)
-    print(f"Total size of training set: {n_samples}")
-    n_batches = count_batches_in_combined_loader(dataloader)
-    print(f"Number of batches in training set: {n_batches}")
-
-    # Training
-    total_loss = 0.0
+    # Training (loss is accumulated on the device to avoid a host sync
+    # on every batch)
+    total_loss = torch.zeros((), device=device)
     input_lengths = ['2s', '3s', '4s']
     batch_n = 0
+    sample = 0
     for combined_batches in dataloader:
         # Randomise order of input lengths shown to network
         random.shuffle(input_lengths)
+
+        # Move batches to GPU and upcast signals stored at half precision.
+        # CombinedLoader returns none for a given loader if that loader has
+        # been exhausted (using "max_size" iteration mode)
+        batches = []
         for length in input_lengths:
-            # CombinedLoader returns none for a given loader if that loader
-            # has been exhausted (using "max_size" iteration mode)
             if combined_batches[length] is None:
                 continue
-
             X, y = combined_batches[length]
-
-            # Move batch to GPU
-            X, y = X.to(device), y.to(device)
-
-            # Compute prediction error
-            pred = model(X)
-            loss = loss_fn(pred, y)
-            total_loss += loss.item()
-
-            # Backpropagation
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            batches.append((length, (X.to(device, non_blocking=True).float(), y.to(device, non_blocking=True))))
+
+        # Optionally propagate all input lengths as a single padded batch
+        if combine_lengths:
+            batches = [combine_batches(batches)]
+
+        # Each optimiser step covers a single batch, unless input lengths
+        # run on their own streams, in which case gradients for all lengths
+        # are accumulated into one step
+        steps = [batches] if streams is not None else [[batch] for batch in batches]
+
+        for step_batches in steps:
+            optimizer.zero_grad(set_to_none=True)
+            losses = []
+            for length, (X, y) in step_batches:
+                # Compute prediction error in mixed precision
+                with length_stream(streams, length, X, y):
+                    with torch.autocast(device.type, dtype=torch.float16, enabled=scaler.is_enabled()):
+                        pred = compiled_model(X)
+                        loss = loss_fn(pred, y)
+                losses.append(loss)
+                sample += len(X)
+
+            # Wait for all per-length forward passes, then backpropagate them
+            # in one backward pass so that the autograd engine orders the
+            # gradient accumulation across streams
+            if streams is not None:
+                for stream in streams.values():
+                    torch.cuda.current_stream(device).wait_stream(stream)
+            step_loss = sum(losses)
+
+            # Backpropagation with loss scaling to avoid fp16 gradient underflow
+            scaler.scale(step_loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            total_loss += step_loss.detach() / len(losses)
 
             # Print progress
             if batch_n != 0 and batch_n % log_freq == 0:
-                sample = batch_n * len(X)
                 global_step = epoch * n_samples + sample
-                avg_loss = total_loss / batch_n
+                avg_loss = total_loss.item() / batch_n
                 print(f"loss: {avg_loss:>7f} [{sample:>5d}/{n_samples:>5d}]")
                 writer.add_scalar('training loss', avg_loss, global_step)
 
             # Increase batch counter
             batch_n += 1
 
-    avg_loss = total_loss / n_batches
+    avg_loss = total_loss.item() / batch_n
     return avg_loss
 
 
-def validate(dataloader, model, loss_fn, device):
-    n_samples = count_samples_in_combined_loader(dataloader)
-    n_batches = count_batches_in_combined_loader(dataloader)
+def validate(dataloader, n_samples, n_batches, model, compiled_model, loss_fn, device):
     model.eval()
-    total_loss, n_correct = 0, 0
+    total_loss = torch.zeros((), device=device)
+    n_correct = torch.zeros((), dtype=torch.long, device=device)
     input_lengths = ['2s', '3s', '4s']
     with torch.no_grad():
         for combined_batches in dataloader:
@@ -96,17 +145,18 @@ def validate(dataloader, model, loss_fn, device):
 
                 X, y = combined_batches[length]
 
-                # Move batch to GPU
-                X, y = X.to(device), y.to(device)
+                # Move batch to GPU and upcast signals stored at half precision
+                X, y = X.to(device, non_blocking=True).float(), y.to(device, non_blocking=True)
 
-                # Compute prediction error
-                pred = model(X)
-                total_loss += loss_fn(pred, y).item()
-                n_correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+                # Compute prediction error (in mixed precision, as in training)
+                with torch.autocast(device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+                    pred = compiled_model(X)
+                    total_loss += loss_fn(pred, y)
+                n_correct += (pred.argmax(1) == y).sum()
 
     # Compute average loss and accuracy
-    avg_loss = total_loss / n_batches
-    acc = n_correct / n_samples * 100
+    avg_loss = total_loss.item() / n_batches
+    acc = n_correct.item() / n_samples * 100
     print(f"Validation set: \n Accuracy: {acc:>0.1f}%, Avg loss: {avg_loss:>8f} \n")
 
     return avg_loss, acc
@@ -117,9 +167,37 @@ def write_scalars(writer, metrics, epoch):
         writer.add_scalar(metric, value, epoch)
 
 
-def build_loader(data_dir, batch_size, shuffle):
-    dataset = SignalDataset(f"{data_dir}/positive.pt", f"{data_dir}/negative.pt")
-    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+def save_checkpoint(executor, state, path):
+    # Serialise to disk in the background so the next epoch can start
+    return executor.submit(torch.save, state, path)
+
+
+def build_loader(data_dir, batch_size, shuffle, device, drop_last=False):
+    # Store signals at half precision on the GPU path to halve loader memory
+    # and the size of host-to-device copies
+    dtype = torch.float16 if device.type == 'cuda' else None
+    dataset = SignalDataset(f"{data_dir}/positive.pt", f"{data_dir}/negative.pt", dtype=dtype)
+
+    # Sample whole batches of indices so that each batch is gathered from
+    # the dataset tensors with one indexing op rather than collated sample
+    # by sample
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+
+    # Load batches into page-locked memory so that host-to-device copies
+    # can run asynchronously. Batches are gathered from in-memory tensors,
+    # so they are loaded in the main process rather than worker processes
+    loader = DataLoader(dataset,
+                        sampler=sampler,
+                        batch_size=None,
+                        num_workers=0,
+                        pin_memory=device.type == 'cuda')
+
+    # Copy the next batch to the GPU on a side stream while the current
+    # batch is being processed
+    if device.type == 'cuda':
+        loader = CUDAPrefetcher(loader, device)
+    return loader
 
 
 def main():
@@ -145,30 +223,51 @@ def main():
 
     exp_id = exp_dir.split('/')[-1]
 
+    # Get device for training
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    print(f"Using {device} device")
+
     # Create data loaders
 
     print("Creating data loaders...")
-    train_2s_loader = build_loader(f"{data_dir}/2s/train", config.batch_size, True)
-    train_3s_loader = build_loader(f"{data_dir}/3s/train", config.batch_size, True)
-    train_4s_loader = build_loader(f"{data_dir}/4s/train", config.batch_size, True)
+
+    # The model is only compiled on the GPU, where training batches drop the
+    # last partial batch so that every compiled training graph sees a
+    # static shape
+    drop_last = device.type == 'cuda'
+    train_2s_loader = build_loader(f"{data_dir}/2s/train", config.batch_size, True, device, drop_last)
+    train_3s_loader = build_loader(f"{data_dir}/3s/train", config.batch_size, True, device, drop_last)
+    train_4s_loader = build_loader(f"{data_dir}/4s/train", config.batch_size, True, device, drop_last)
     train_loaders = {'2s': train_2s_loader,
                      '3s': train_3s_loader,
                      '4s': train_4s_loader}
     train_loader = CombinedLoader(train_loaders, mode="max_size")
 
-    val_2s_loader = build_loader(f"{data_dir}/2s/val", config.batch_size, False)
-    val_3s_loader = build_loader(f"{data_dir}/3s/val", config.batch_size, False)
-    val_4s_loader = build_loader(f"{data_dir}/4s/val", config.batch_size, False)
+    val_2s_loader = build_loader(f"{data_dir}/2s/val", config.batch_size, False, device)
+    val_3s_loader = build_loader(f"{data_dir}/3s/val", config.batch_size, False, device)
+    val_4s_loader = build_loader(f"{data_dir}/4s/val", config.batch_size, False, device)
     val_loaders = {'2s': val_2s_loader,
                    '3s': val_3s_loader,
                    '4s': val_4s_loader}
     val_loader = CombinedLoader(val_loaders, mode="max_size")
 
-    # Get device for training
-
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    device = torch.device(device)
-    print(f"Using {device} device")
+    # Compute number of batches and total number of instances once, since
+    # the loaders do not change between epochs
+    n_train_samples = count_samples_in_combined_loader(train_loader)
+    n_train_batches = count_batches_in_combined_loader(train_loader)
+    print(f"Total size of training set: {n_train_samples}")
+    print(f"Number of batches in training set: {n_train_batches}")
+    n_val_samples = count_samples_in_combined_loader(val_loader)
+    n_val_batches = count_batches_in_combined_loader(val_loader)
+
+    # Input lengths and architecture are fixed, so let cuDNN autotune the
+    # fastest convolution algorithms and use TF32 on Ampere+ GPUs
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
 
     # Define model
 
@@ -192,15 +291,58 @@ def main():
         assert start_epoch == 0
     summary(model)
 
+    # Whether to run each input length's forward pass on its own CUDA
+    # stream, with one backward pass and optimiser step across all lengths.
+    # Concurrent training-mode forwards would race on the running
+    # statistics of normalisation layers, so such models are refused
+
+    if device.type == 'cuda' and config.get('length_streams', False):
+        if any(getattr(m, 'running_mean', None) is not None for m in model.modules()):
+            print(f"length_streams is not supported for {config.model} model - it tracks normalisation running statistics")
+            exit()
+        streams = {length: torch.cuda.Stream(device) for length in train_loaders}
+    else:
+        streams = None
+
+    # Compile model to fuse pointwise ops and replay kernel launches from
+    # CUDA graphs (the uncompiled model is kept for saving checkpoints).
+    # Shapes are kept static, so one graph is cached per input shape and
+    # train/eval mode: a full batch per length in training, plus full and
+    # partial batches per length in validation. Raise the recompile limit
+    # above that count so no shape silently falls back to eager mode.
+    # CUDA graphs share one memory pool and assume their replays are
+    # serialised, so they are not used when lengths run on separate streams.
+
+    if device.type == 'cuda':
+        dynamo_config = torch._dynamo.config
+        limit = 'recompile_limit' if hasattr(dynamo_config, 'recompile_limit') else 'cache_size_limit'
+        setattr(dynamo_config, limit, 32)
+        mode = "default" if streams is not None else "reduce-overhead"
+        compiled_model = torch.compile(model, mode=mode, dynamic=False)
+    else:
+        compiled_model = model
+
     # Define loss function & optimiser
 
     loss_fn = nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=config.learning_rate)
+    optimizer = torch.optim.Adam(model.parameters(), lr=config.learning_rate, fused=device.type == 'cuda')
+
+    # Mixed precision is only used when training on the GPU
+    scaler = torch.amp.GradScaler('cuda', enabled=device.type == 'cuda')
 
     # Set up TensorBoard
 
     writer = SummaryWriter()
 
+    # Whether to train on all input lengths at once as one padded batch
+
+    combine_lengths = config.get('combine_lengths', False)
+
+    # Write checkpoints on a background thread
+
+    checkpt_executor = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
+
     # Train
 
     best_acc = 0
@@ -210,12 +352,12 @@ def main():
         
         # Training
         start_train_t = time.time()
-        train_loss = train(train_loader, model, loss_fn, optimizer, device, writer, t)
+        train_loss = train(train_loader, n_train_samples, model, compiled_model, loss_fn, optimizer, scaler, device, writer, t, combine_lengths, streams)
         end_train_t = time.time()
 
         # Validation
         start_val_t = end_train_t
-        val_loss, val_acc = validate(val_loader, model, loss_fn, device)
+        val_loss, val_acc = validate(val_loader, n_val_samples, n_val_batches, model, compiled_model, loss_fn, device)
         end_val_t = time.time()
 
         # Compute walltime taken for training and validation loops
@@ -231,16 +373,30 @@ def main():
                    'train - val loss': train_loss - val_loss}
         write_scalars(writer, metrics, t)
         
+        # Surface any error from the previous epoch's checkpoint writes
+        for save in pending_saves:
+            save.result()
+        pending_saves = []
+
+        # Snapshot weights to CPU so training can continue while they are
+        # written out
+        state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
         # Save model if it is the best so far
         if val_acc > best_acc:
             best_acc = val_acc
             best_epoch = t
-            torch.save(model.state_dict(), f"{exp_dir}/{exp_id}_{start_epoch}_best_model.pth")
-            print(f"Saved best model at epoch {t} with val accuracy {best_acc}.")
+            pending_saves.append(save_checkpoint(checkpt_executor, state, f"{exp_dir}/{exp_id}_{start_epoch}_best_model.pth"))
+            print(f"Saving best model at epoch {t} with val accuracy {best_acc}.")
 
         # Always save latest model in case training is interrupted
-        torch.save(model.state_dict(), f"{exp_dir}/{exp_id}_latest_model.pth")
-        print(f"Saved latest model at epoch {t} with val accuracy {val_acc}.")
+        pending_saves.append(save_checkpoint(checkpt_executor, state, f"{exp_dir}/{exp_id}_latest_model.pth"))
+        print(f"Saving latest model at epoch {t} with val accuracy {val_acc}.")
+
+    # Wait for outstanding checkpoint writes, raising any write error
+    for save in pending_saves:
+        save.result()
+    checkpt_executor.shutdown(wait=True)
 
     print(f"Best model with validation accuracy {best_acc} saved at epoch {best_epoch}.")
 